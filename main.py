@@ -2,20 +2,54 @@
 # Created by GGomeSC, 11.06.2024
 
 import pandas as pd
+import numpy as np
 import os
 import re
 import json
 import logging
 import time
+import functools
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import python_calamine  # noqa: F401 - only checked for availability
+    EXCEL_ENGINE = 'calamine'  # Streams rows straight from the zipped XML instead of building a DOM like openpyxl
+except ImportError:
+    EXCEL_ENGINE = 'openpyxl'
+
+try:
+    import xlsxwriter  # noqa: F401 - only checked for availability
+    EXCEL_WRITER_ENGINE = 'xlsxwriter'  # Writes the workbook considerably faster and leaner than openpyxl
+except ImportError:
+    EXCEL_WRITER_ENGINE = 'openpyxl'
+
+try:
+    import pyarrow  # noqa: F401 - only checked for availability
+    STRING_DTYPE = 'string[pyarrow]'  # Contiguous UTF-8 buffers instead of one Python object per cell
+except ImportError:
+    STRING_DTYPE = 'string'
+
+# Only these columns of the Attendance Reports are used, so the rest are never parsed
+REPORT_COLUMNS = ['Duração', 'Enviar e-mail']
+
+# Reports handed to a worker process at a time; fewer reports than this are read without starting any workers
+REPORTS_PER_WORKER = 4
+
+# Regex that extracts the incident ID from the meeting title, in our case it's "GV-"
+INCIDENT_ID_PATTERN = re.compile(r'(GV-\d+)')
+
+# Each unit is searched for independently through its own lookahead, anywhere in the string and in any order
+DURATION_PATTERN = re.compile(r'^(?=(?:.*?(\d+)\s*h)?)(?=(?:.*?(\d+)\s*min)?)(?=(?:.*?(\d+)\s*s)?)', re.DOTALL)
 
 logging.basicConfig(filename='execution_log.log', level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
 
 # Create a config.json file in the same directory as this script and speficy the root_folder's path and output_directory'path that you want
+@functools.lru_cache(maxsize=1)  # The config is only parsed once, even when imported and called repeatedly
 def load_config():
     try:
-        # Specify the full path to the config file
-        dir_path = os.path.dirname(os.path.realpath(__file__))  # Gets the directory where the script is located
-        config_path = os.path.join(dir_path, 'config.json')  # Path to the config file
+        # Specify the full path to the config file, in the directory where the script is located
+        config_path = Path(__file__).resolve().parent / 'config.json'
         print("Current working directory:", os.getcwd())
         with open(config_path, 'r') as config_file:
             return json.load(config_file)
@@ -26,6 +60,7 @@ def load_config():
         logging.error("Configuration file is not valid JSON.")
         raise json.JSONDecodeError("Configuration file is not valid JSON.")
 
+@functools.lru_cache(maxsize=1)
 def load_wage_info():
     try:
         with open('wage_info.json', 'r') as wage_file:
@@ -36,80 +71,101 @@ def load_wage_info():
         raise Exception("Wage information file is not valid JSON. Please check the 'wage_info.json' for errors.")
 
 def calculate_total_labor_cost(df, wage_info):
-    # Map email to role and then role to wage
-    df['Role'] = df['Enviar e-mail'].map(wage_info['employees']).fillna('Supplier')
-    df['Hourly Wage'] = df['Role'].map(wage_info['wages'])
+    # Map email to role and then role to wage once per distinct email, then gather both for every row by integer code
+    emails = df['Enviar e-mail'].astype('category')  # No-op when main() already made it categorical
+    roles = pd.Categorical([wage_info['employees'].get(email, 'Supplier') for email in emails.cat.categories] + ['Supplier'])
+    role_codes = roles.codes[emails.cat.codes.to_numpy()]  # Rows without an email have code -1, i.e. the trailing 'Supplier'
+    wages = np.array([wage_info['wages'].get(role, np.nan) for role in roles.categories], dtype=float)
+    df['Role'] = pd.Categorical.from_codes(role_codes, categories=roles.categories)
+    df['Hourly Wage'] = wages[role_codes]
     # Calculate cost for each entry
     df['Cost'] = df['Duration in minutes'] / 60 * df['Hourly Wage']
 
     # Calculate the total cost and total duration per role for each incident
     aggregation_functions = {'Cost': 'sum', 'Duration in minutes': 'sum'}
-    costs_and_durations = df.pivot_table(values=['Cost', 'Duration in minutes'], index='Incident ID', columns='Role', aggfunc=aggregation_functions, fill_value=0)
+    costs_and_durations = df.pivot_table(values=['Cost', 'Duration in minutes'], index='Incident ID', columns='Role', aggfunc=aggregation_functions, fill_value=0, observed=True)
 
     # Format the total durations per role
     for role in costs_and_durations['Duration in minutes'].columns:
-        costs_and_durations[('Formatted Duration', role)] = costs_and_durations['Duration in minutes'][role].apply(minutes_to_hours)
-        print("Converting minutes to hours...")
+        costs_and_durations[('Formatted Duration', role)] = format_durations(costs_and_durations['Duration in minutes'][role])
 
     # Sum costs by incident to get total cost
     costs_and_durations['Total Cost (R$)'] = costs_and_durations['Cost'].sum(axis=1)
 
     return costs_and_durations.reset_index()
 
-def parse_duration(duration_str):
-    total_minutes = 0
-    if pd.isna(duration_str):
-        return 0
-    hours = re.findall(r'(\d+)\s*h', duration_str)
-    minutes = re.findall(r'(\d+)\s*min', duration_str)
-    seconds = re.findall(r'(\d+)\s*s', duration_str)
-    if hours:
-        total_minutes += int(hours[0]) * 60
-    if minutes:
-        total_minutes += int(minutes[0])
-    if seconds:
-        total_minutes += int(seconds[0]) // 60 if int(seconds[0]) >= 30 else 0
-    return total_minutes
-
-def minutes_to_hours(minutes):
-    hours = minutes // 60
-    remainder_minutes = minutes % 60
-    return f"{hours}:{remainder_minutes:02d}"
+def parse_durations(durations):
+    # Extract hours, minutes and seconds of every row in one vectorized pass, e.g. '1 h 5 min' or '45 min 30 s'
+    parts = durations.str.extract(DURATION_PATTERN).astype(float).fillna(0).astype(int)
+    hours, minutes, seconds = parts[0], parts[1], parts[2]
+    return hours * 60 + minutes + seconds // 60
 
-def aggregate_excel_files(root_folder):
-    aggregated_df = pd.DataFrame()
+def format_durations(minutes):
+    # Formats a whole Series of minutes as 'h:mm' at once
+    hours, remainder_minutes = divmod(minutes, 60)
+    return hours.astype(str) + ':' + remainder_minutes.astype(str).str.zfill(2)
+
+def find_excel_files(root_folder):
+    file_paths = []
     for subdir, dirs, files in os.walk(root_folder):
         for file in files:
             if file.endswith('.xlsx'):
-                file_path = os.path.join(subdir, file)
-                df = pd.read_excel(file_path)
-                df['Incident Info'] = os.path.basename(subdir)  # Assign file name to Incident Info
-                aggregated_df = pd.concat([aggregated_df, df], ignore_index=True)
-    return aggregated_df
+                file_paths.append(os.path.join(subdir, file))
+    return file_paths
+
+def read_attendance_report(file_path):
+    try:
+        df = pd.read_excel(file_path, usecols=REPORT_COLUMNS, engine=EXCEL_ENGINE)
+    except ValueError as e:
+        # Only reports that lack one of the columns are retried, reading them in full with the missing columns left empty
+        if 'Usecols do not match columns' not in str(e):
+            raise
+        logging.warning(f"'{file_path}' does not contain all of the columns {REPORT_COLUMNS}.")
+        df = pd.read_excel(file_path, engine=EXCEL_ENGINE).reindex(columns=REPORT_COLUMNS)
+    df['Incident Info'] = os.path.basename(os.path.dirname(file_path))  # Assign file name to Incident Info
+    return df
+
+def aggregate_excel_files(root_folder):
+    file_paths = find_excel_files(root_folder)
+    if not file_paths:
+        return pd.DataFrame(columns=REPORT_COLUMNS + ['Incident Info'], dtype=STRING_DTYPE)
+    # Each report is parsed independently, so spread the (CPU-bound) XML parsing across the cores, but only start as
+    # many workers as there are batches of reports: every spawned worker has to import pandas again first
+    # (61 is the most ProcessPoolExecutor accepts on Windows)
+    workers = min(-(-len(file_paths) // REPORTS_PER_WORKER), os.cpu_count() or 1, 61)
+    if workers == 1:
+        frames = [read_attendance_report(file_path) for file_path in file_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            frames = list(executor.map(read_attendance_report, file_paths, chunksize=REPORTS_PER_WORKER))
+    # Concatenate once at the end instead of re-copying the growing DataFrame for every file; the email column is turned
+    # into a category afterwards in main(), which is faster than giving every frame shared categories before the concat
+    return pd.concat(frames, ignore_index=True).astype(STRING_DTYPE)
 
 def main():
     try:
         wage_info = load_wage_info()
-        start_time = time.time()  # Record the start time
         config = load_config()
         root_folder = config['root_folder']
         output_directory = config['output_directory']
         output_file = 'total_cost_per_incident.xlsx'
-        # Ensure the output directory exists
-        if not os.path.exists(output_directory):
-            os.makedirs(output_directory)
-            print("Creating the output directory...")
+        os.makedirs(output_directory, exist_ok=True)  # Ensure the output directory exists
+        start_time = time.time()  # Record the start time
 
         # Make sure that you match exactly the strings of the columns that you want to extract. 'Duração' and 'Enviar e-mail' are from Attendance Reports using a Portuguese Google Workspace
-        df = aggregate_excel_files(root_folder) 
-        print("Aggregating all in one Excel file...")
-        df['Incident ID'] = df['Incident Info'].str.extract(r'(GV-\d+)') # Regex that extracts the incident ID from that meeting title, in our case it's "GV-"
+        df = aggregate_excel_files(root_folder)
+        logging.info(f"Aggregated {len(df)} attendance rows from '{root_folder}'.")
+        df['Incident ID'] = df['Incident Info'].str.extract(INCIDENT_ID_PATTERN, expand=False)
         df['Incident ID'] = df['Incident ID'].fillna(df['Incident Info'])
-        df['Duration in minutes'] = df['Duração'].apply(parse_duration)
-        aggregated_df = df.groupby(['Incident ID', 'Enviar e-mail']).agg({'Duration in minutes': 'sum'}).reset_index()
-        aggregated_df['Meetings Attended'] = df.groupby(['Incident ID', 'Enviar e-mail'])['Incident Info'].transform('nunique')
-        aggregated_df['Formatted Duration'] = aggregated_df['Duration in minutes'].apply(minutes_to_hours)
-        print("Converting minutes to hours...")
+        # Group keys as categories so groupby hashes integer codes instead of Python strings
+        df['Incident ID'] = df['Incident ID'].astype('category')
+        df['Enviar e-mail'] = df['Enviar e-mail'].astype('category')
+        df['Duration in minutes'] = parse_durations(df['Duração'])
+        aggregated_df = df.groupby(['Incident ID', 'Enviar e-mail'], sort=False, observed=True).agg(**{
+            'Duration in minutes': ('Duration in minutes', 'sum'),
+            'Meetings Attended': ('Incident Info', 'nunique'),
+        }).reset_index()
+        aggregated_df['Formatted Duration'] = format_durations(aggregated_df['Duration in minutes'])
 
         try:
             total_costs_durations = calculate_total_labor_cost(df, wage_info)
@@ -122,7 +178,7 @@ def main():
             print(f"An error occurred: {e}")
         
         # Save the file to the specified directory
-        total_costs_durations.to_excel(os.path.join(output_directory, output_file), index=False)
+        total_costs_durations.to_excel(os.path.join(output_directory, output_file), index=False, engine=EXCEL_WRITER_ENGINE)
         logging.info(f"Total cost data saved to '{os.path.join(output_directory, output_file)}'.")
         
         end_time = time.time()  # Record the end time